@@ -5,15 +5,122 @@ Creates a texture atlas from multiple images in a directory.
 Supports .png, .jpeg, .jpg, .webm, and .webp formats.
 """
 
+import io
 import os
 import sys
 import math
-from PIL import Image
+import mmap
+import hashlib
+import threading
+import numpy as np
+import PIL
+from PIL import Image, UnidentifiedImageError, features
 import argparse
-from typing import List, Tuple, Dict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, List, Tuple, Dict
+
+# Files above this size are memory-mapped instead of read into a bytes object
+MMAP_THRESHOLD = 1024 * 1024
+
+def blit_tile(atlas: np.ndarray, tile: np.ndarray, x: int, y: int):
+    """Copy an RGB or RGBA tile into the RGBA atlas buffer with its top-left corner at (x, y).
+    
+    Each assignment is a strided row-by-row memcpy inside NumPy, so the copy already
+    runs at compiled speed without a JIT. RGB tiles, which only come from sources with
+    no transparency, get an opaque alpha channel.
+    """
+    target = atlas[y:y + tile.shape[0], x:x + tile.shape[1]]
+    # Cells past the atlas edge are clipped, matching Image.paste
+    tile = tile[:target.shape[0], :target.shape[1]]
+    if tile.shape[2] == 4:
+        target[...] = tile
+    else:
+        target[..., :3] = tile
+        target[..., 3] = 255
+
+def expand_palette(image: Image.Image) -> np.ndarray:
+    """Expand a 'P' mode image to an RGBA array with a single palette lookup."""
+    palette = np.zeros((256, 4), dtype=np.uint8)
+    palette[:, 3] = 255
+    entries = np.asarray(image.getpalette('RGBA'), dtype=np.uint8).reshape(-1, 4)
+    palette[:len(entries)] = entries
+    
+    # PNG/GIF store palette transparency outside the palette itself
+    transparency = image.info.get('transparency')
+    if isinstance(transparency, int):
+        palette[transparency, 3] = 0
+    elif isinstance(transparency, bytes):
+        palette[:len(transparency), 3] = np.frombuffer(transparency, dtype=np.uint8)
+    
+    return palette[np.asarray(image)]
+
+@dataclass
+class AtlasMapping:
+    """Placement of every sprite in the atlas, stored as parallel int32 arrays.
+    
+    Entry i of each array belongs to filenames[i]. All cells share one size.
+    """
+    cell_width: int
+    cell_height: int
+    filenames: List[str]
+    xs: np.ndarray
+    ys: np.ndarray
+    widths: np.ndarray
+    heights: np.ndarray
+    cell_xs: np.ndarray
+    cell_ys: np.ndarray
+    original_widths: np.ndarray
+    original_heights: np.ndarray
+    
+    ARRAY_FIELDS = ('xs', 'ys', 'widths', 'heights', 'cell_xs', 'cell_ys', 'original_widths', 'original_heights')
+    
+    @classmethod
+    def allocate(cls, capacity: int, cell_width: int, cell_height: int) -> 'AtlasMapping':
+        """Create a mapping with room for capacity sprites."""
+        arrays = {name: np.zeros(capacity, dtype=np.int32) for name in cls.ARRAY_FIELDS}
+        return cls(cell_width=cell_width, cell_height=cell_height, filenames=[], **arrays)
+    
+    def shrink_to_fit(self):
+        """Drop the unused tail of the arrays left by images that failed to load."""
+        count = len(self.filenames)
+        for name in self.ARRAY_FIELDS:
+            setattr(self, name, getattr(self, name)[:count])
+    
+    def __len__(self) -> int:
+        return len(self.filenames)
+
+class TileCache:
+    """Resized tiles keyed by file content and cell size, shared by the workers of one atlas.
+    
+    The first worker to claim a key decodes the file and publishes the tile; workers
+    holding duplicates of it wait on the slot's event instead of decoding again.
+    """
+    
+    class Slot:
+        def __init__(self):
+            self.ready = threading.Event()
+            self.tile: np.ndarray = None
+            self.original_size: Tuple[int, int] = None
+            self.error: Exception = None
+    
+    def __init__(self):
+        self._slots: Dict[Tuple, 'TileCache.Slot'] = {}
+        self._lock = threading.Lock()
+    
+    def claim(self, key: Tuple) -> Tuple['TileCache.Slot', bool]:
+        """Return the slot for key and whether the caller is the one that must fill it."""
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is not None:
+                return slot, False
+            slot = self._slots[key] = TileCache.Slot()
+            return slot, True
 
 class ImageAtlasGenerator:
-    def __init__(self, input_dir: str, output_path: str, output_name: str, sprite_width: int, sprite_height: int, atlas_width: int, atlas_height: int):
+    def __init__(self, input_dir: str, output_path: str, output_name: str, sprite_width: int, sprite_height: int, atlas_width: int, atlas_height: int,
+                 output_format: str = 'png', compress_level: int = 1, max_workers: int = None):
         self.input_dir = input_dir
         self.output_path = output_path
         self.output_name = output_name
@@ -21,45 +128,141 @@ class ImageAtlasGenerator:
         self.sprite_height = sprite_height
         self.atlas_width = atlas_width
         self.atlas_height = atlas_height
+        self.output_format = output_format
+        self.compress_level = compress_level
+        self.max_workers = os.cpu_count() if max_workers is None else max_workers
+        self.atlas_file = Path(output_path) / f"{output_name}-atlas.{output_format}"
+        self._atlas_save: Future = None
         self.supported_formats = {'.png', '.jpeg', '.jpg', '.webm', '.webp'}
+        self._ext_no_dot = {ext[1:] for ext in self.supported_formats}
         
-    def get_image_files(self) -> List[str]:
-        """Get all supported image files from the input directory."""
-        image_files = []
+        # Pillow-SIMD builds carry a .postN suffix on the version string
+        simd_note = " (SIMD build)" if ".post" in PIL.__version__ else " (stock build, consider pillow-simd)"
+        print(f"Using Pillow {PIL.__version__}{simd_note}")
         
+        # JPEG decode dominates for JPEG-heavy inputs; libjpeg-turbo is several times faster
+        if not features.check_feature('libjpeg_turbo'):
+            print("Warning: Pillow is not linked against libjpeg-turbo, JPEG decoding will be slow")
+        
+    def get_image_files(self) -> List[os.DirEntry]:
+        """Get all supported image files from the input directory, sorted by name."""
         if not os.path.exists(self.input_dir):
             raise FileNotFoundError(f"Input directory '{self.input_dir}' does not exist")
             
-        for filename in os.listdir(self.input_dir):
-            file_ext = os.path.splitext(filename)[1].lower()
-            if file_ext in self.supported_formats:
-                image_files.append(os.path.join(self.input_dir, filename))
+        image_files = []
+        with os.scandir(self.input_dir) as it:
+            for entry in it:
+                stem, dot, ext = entry.name.rpartition('.')
+                # Like os.path.splitext, names without a dot ("png") and dotfiles (".png")
+                # have no extension
+                if dot and stem and ext.lower() in self._ext_no_dot and entry.is_file():
+                    image_files.append(entry)
                 
-        return sorted(image_files)
+        return sorted(image_files, key=lambda entry: entry.name)
     
     def calculate_grid_size(self, num_images: int) -> Tuple[int, int]:
         """Calculate optimal grid dimensions for the given number of images."""
         if num_images == 0:
             return 1, 1
             
-        # Try to make the grid as square as possible
-        cols = math.floor(math.sqrt((self.atlas_width / self.sprite_width) * num_images))
-        rows = math.ceil(num_images / cols)
+        # Try to make the grid as square as possible, without letting a row
+        # run past the atlas edge. Integer math keeps this exact near perfect squares.
+        max_cols = max(1, self.atlas_width // self.sprite_width)
+        cols = min(max_cols, max(1, math.isqrt(max_cols * num_images)))
+        rows = -(-num_images // cols)
         
         return cols, rows
     
-    def resize_image_to_fit(self, image: Image.Image, cell_width: int, cell_height: int) -> Image.Image:
-        """Resize image to fit within cell dimensions while maintaining aspect ratio."""
-        scale_x = cell_width / image.width
-        scale_y = cell_height / image.height
-        scale = min(scale_x, scale_y)
+    def resize_image_to_fit(self, image: Image.Image, cell_width: int, cell_height: int,
+                            _lanczos: Image.Resampling = Image.Resampling.LANCZOS) -> Image.Image:
+        """Resize image to fit within cell dimensions while maintaining aspect ratio.
+        
+        Images larger than the cell are shrunk in place with thumbnail(), so the
+        passed-in image may be modified. Smaller images are scaled up into a new image.
+        The resampling filter is bound as a default argument to skip the per-call
+        module and enum attribute lookups.
+        """
+        if image.width > cell_width or image.height > cell_height:
+            image.thumbnail((cell_width, cell_height), _lanczos)
+            return image
+        
+        # thumbnail() never enlarges, so scale small sprites up to fill the cell
+        scale = min(cell_width / image.width, cell_height / image.height)
         
         new_width = int(image.width * scale)
         new_height = int(image.height * scale)
         
-        return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        return image.resize((new_width, new_height), _lanczos)
+    
+    def _decode_and_resize(self, source: BinaryIO, cell_width: int, cell_height: int) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """Decode an in-memory image file and resize it into an RGB or RGBA tile."""
+        with Image.open(source) as img:
+            original_size = (img.width, img.height)
+            
+            # Sprite-sheet fast path: the source already fills the cell exactly
+            if img.size == (cell_width, cell_height) and img.mode == 'RGBA':
+                return np.asarray(img), original_size
+            
+            # Let libjpeg decode straight to a reduced DCT scale (1/2, 1/4, 1/8) that is
+            # still at least the cell size, skipping most of the IDCT work
+            if img.format == 'JPEG' and img.width >= 2 * cell_width and img.height >= 2 * cell_height:
+                img.draft('RGB', (cell_width, cell_height))
+            
+            # Plain RGB resamples natively and stays three-channel; its opaque alpha is
+            # filled in during the blit instead of allocating a converted RGBA copy. An RGB
+            # tRNS colour key is not opaque, and Lanczos would blend the key colour into its
+            # neighbours, so keyed sources become real RGBA before the resize.
+            if img.mode == 'P':
+                img = Image.fromarray(expand_palette(img))
+            elif img.mode not in ('RGB', 'RGBA') or 'transparency' in img.info:
+                img = img.convert('RGBA')
+            
+            resized_img = self.resize_image_to_fit(img, cell_width, cell_height)
+            # Copy the pixels out before the source image is closed
+            return np.ascontiguousarray(np.asarray(resized_img)), original_size
+    
+    def _load_and_resize(self, entry: os.DirEntry, cell_width: int, cell_height: int,
+                         tile_cache: TileCache) -> Tuple[str, np.ndarray, Tuple[int, int]]:
+        """Load a single image as a resized RGB or RGBA tile. Safe to run from a worker thread.
+        
+        Files with identical content share one decode and resize through tile_cache.
+        """
+        # Unbuffered open: the file is pulled into memory in one read (or mapped), so
+        # the decoder works on a single contiguous buffer with no Python-level reads
+        with open(entry.path, 'rb', 0) as f:
+            size = os.fstat(f.fileno()).st_size
+            if size > MMAP_THRESHOLD:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                source = data
+            else:
+                data = f.read()
+                source = io.BytesIO(data)
+        
+        try:
+            # The whole file is in memory for decoding anyway, so hash all of it rather than a prefix
+            key = (len(data), hashlib.blake2b(data, digest_size=16).digest(), cell_width, cell_height)
+            slot, is_owner = tile_cache.claim(key)
+            
+            if is_owner:
+                try:
+                    slot.tile, slot.original_size = self._decode_and_resize(source, cell_width, cell_height)
+                except Exception as e:
+                    slot.error = e
+                finally:
+                    slot.ready.set()
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        
+        slot.ready.wait()
+        if isinstance(slot.error, UnidentifiedImageError):
+            # Pillow only saw an in-memory buffer, so put the file name back in the message
+            raise UnidentifiedImageError(f"cannot identify image file {entry.path!r}") from slot.error
+        if slot.error is not None:
+            raise slot.error
+        return entry.name, slot.tile, slot.original_size
     
-    def create_atlas(self) -> Dict[str, Dict]:
+    def create_atlas(self) -> AtlasMapping:
         """Create the texture atlas and return mapping information."""
         image_files = self.get_image_files()
         
@@ -71,75 +274,136 @@ class ImageAtlasGenerator:
         cols, rows = self.calculate_grid_size(len(image_files))
         print(f"Using {cols}x{rows} grid layout")
         
+        # Bind everything the per-sprite loop touches to locals up front
         cell_width = self.sprite_width
         cell_height = self.sprite_height
+        load_and_resize = self._load_and_resize
+        # Local to this call, so the tiles are released once the atlas is built
+        tile_cache = TileCache()
         
         print(f"Each cell will be {cell_width}x{cell_height} pixels")
         
-        atlas = Image.new('RGBA', (self.atlas_width, self.atlas_height), (0, 0, 0, 0))
+        # The canvas starts fully transparent and cells never overlap, so blitting
+        # the raw RGBA pixels is equivalent to (and much cheaper than) alpha compositing
+        atlas_np = np.zeros((self.atlas_height, self.atlas_width, 4), dtype=np.uint8)
         
-        atlas_mapping = {}
+        atlas_mapping = AtlasMapping.allocate(len(image_files), cell_width, cell_height)
+        filenames = atlas_mapping.filenames
+        xs, ys = atlas_mapping.xs, atlas_mapping.ys
+        widths, heights = atlas_mapping.widths, atlas_mapping.heights
+        mapped_cell_xs, mapped_cell_ys = atlas_mapping.cell_xs, atlas_mapping.cell_ys
+        original_widths, original_heights = atlas_mapping.original_widths, atlas_mapping.original_heights
         
-        for i, image_path in enumerate(image_files):
-            try:
-                col = i % cols
-                row = i // cols
-                
-                x = col * cell_width
-                y = row * cell_height
-                
-                print(f"Processing: {os.path.basename(image_path)}")
-                
-                with Image.open(image_path) as img:
-                    if img.mode != 'RGBA':
-                        img = img.convert('RGBA')
+        # Every cell origin is known from the grid alone, so compute them all in one
+        # vectorized pass. Paste offsets still depend on each decoded tile's size.
+        cell_indices = np.arange(len(image_files))
+        cell_xs = ((cell_indices % cols) * cell_width).tolist()
+        cell_ys = ((cell_indices // cols) * cell_height).tolist()
+        
+        # Decode and resize in parallel (Pillow releases the GIL in its codecs and
+        # resampler), then blit serially into the shared atlas buffer
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                (i, entry, executor.submit(load_and_resize, entry, cell_width, cell_height, tile_cache))
+                for i, entry in enumerate(image_files)
+            ]
+            
+            # Consume results in submission order rather than as_completed(): cells are then
+            # blitted in row-major grid order, which walks the row-major atlas buffer
+            # sequentially however the worker threads happen to finish
+            for i, entry, future in futures:
+                try:
+                    filename, tile, original_size = future.result()
+                    tile_height, tile_width = tile.shape[:2]
                     
-                    resized_img = self.resize_image_to_fit(img, cell_width, cell_height)
+                    x = cell_xs[i]
+                    y = cell_ys[i]
                     
-                    paste_x = x + (cell_width - resized_img.width) // 2
-                    paste_y = y + (cell_height - resized_img.height) // 2
+                    print(f"Processing: {filename}")
                     
-                    atlas.paste(resized_img, (paste_x, paste_y), resized_img)
+                    paste_x = x + (cell_width - tile_width) // 2
+                    paste_y = y + (cell_height - tile_height) // 2
                     
-                    filename = os.path.basename(image_path)
-                    atlas_mapping[filename] = {
-                        'x': paste_x,
-                        'y': paste_y,
-                        'width': resized_img.width,
-                        'height': resized_img.height,
-                        'cell_x': x,
-                        'cell_y': y,
-                        'cell_width': cell_width,
-                        'cell_height': cell_height,
-                        'original_size': (img.width, img.height)
-                    }
+                    blit_tile(atlas_np, tile, paste_x, paste_y)
                     
-            except Exception as e:
-                print(f"Error processing {image_path}: {e}")
-                continue
+                    n = len(filenames)
+                    xs[n] = paste_x
+                    ys[n] = paste_y
+                    widths[n] = tile_width
+                    heights[n] = tile_height
+                    mapped_cell_xs[n] = x
+                    mapped_cell_ys[n] = y
+                    original_widths[n], original_heights[n] = original_size
+                    filenames.append(filename)
+                        
+                except Exception as e:
+                    print(f"Error processing {entry.path}: {e}")
+                    continue
+        
+        atlas_mapping.shrink_to_fit()
         
-        atlas.save(self.output_path + ("" if self.output_path.endswith("/") else "/") + self.output_name + "-atlus.png", 'PNG')
-        print(f"Atlas saved to: {self.output_path}")
+        atlas = Image.fromarray(atlas_np, 'RGBA')
+        
+        # Encode in the background so the caller can write the mapping file meanwhile;
+        # wait_for_atlas() joins it and re-raises any encoding error
+        save_executor = ThreadPoolExecutor(max_workers=1)
+        self._atlas_save = save_executor.submit(self.save_atlas_image, atlas, self.atlas_file)
+        save_executor.shutdown(wait=False)
         
         return atlas_mapping
     
-    def save_mapping_file(self, mapping: Dict[str, Dict], mapping_path: str = None):
+    def wait_for_atlas(self) -> Path:
+        """Block until the atlas image started by create_atlas() is written, and return its path."""
+        if self._atlas_save is None:
+            raise RuntimeError("create_atlas() has not been called")
+        
+        self._atlas_save.result()
+        print(f"Atlas saved to: {self.atlas_file}")
+        return self.atlas_file
+    
+    def save_atlas_image(self, atlas: Image.Image, atlas_file: Path):
+        """Encode the atlas image. Encoding dominates runtime on large atlases, so favour speed."""
+        if self.output_format == 'webp':
+            # Lossless WebP with the fastest method usually beats PNG on size for sprite content
+            atlas.save(atlas_file, 'WEBP', lossless=True, quality=100, method=0)
+        else:
+            # zlib level 1 encodes ~3x faster than the default level 6 for a small size penalty
+            atlas.save(atlas_file, 'PNG', compress_level=self.compress_level, optimize=False)
+    
+    def save_mapping_file(self, mapping: AtlasMapping, mapping_path: str = None):
         """Save the atlas mapping information to a file."""
         if mapping_path is None:
             mapping_path = os.path.splitext(self.output_path)[0] + '_mapping.txt'
         
+        header = (
+            "# Image Atlas Mapping\n"
+            f"# Atlas Size: {self.atlas_width}x{self.atlas_height}\n"
+            "# Format: filename | x, y, width, height | cell_x, cell_y, cell_width, cell_height | original_width, original_height\n\n"
+        )
+        cell_width, cell_height = mapping.cell_width, mapping.cell_height
+        # One tolist() per column turns the arrays back into plain ints in bulk
+        lines = [
+            f"{filename} | {x}, {y}, {width}, {height} | "
+            f"{cell_x}, {cell_y}, {cell_width}, {cell_height} | "
+            f"{original_width}, {original_height}\n"
+            for filename, x, y, width, height, cell_x, cell_y, original_width, original_height in zip(
+                mapping.filenames, *(getattr(mapping, name).tolist() for name in AtlasMapping.ARRAY_FIELDS)
+            )
+        ]
+        
+        # Build the whole file up front and hand it to the OS in a single write
         with open(mapping_path, 'w') as f:
-            f.write("# Image Atlas Mapping\n")
-            f.write(f"# Atlas Size: {self.atlas_width}x{self.atlas_height}\n")
-            f.write("# Format: filename | x, y, width, height | cell_x, cell_y, cell_width, cell_height | original_width, original_height\n\n")
-            
-            for filename, info in mapping.items():
-                f.write(f"{filename} | {info['x']}, {info['y']}, {info['width']}, {info['height']} | "
-                       f"{info['cell_x']}, {info['cell_y']}, {info['cell_width']}, {info['cell_height']} | "
-                       f"{info['original_size'][0]}, {info['original_size'][1]}\n")
+            f.write(header + "".join(lines))
         
         print(f"Mapping file saved to: {mapping_path}")
 
+def positive_int(value: str) -> int:
+    """argparse type for options that must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
 def main():
     parser = argparse.ArgumentParser(description='Create a texture atlas from multiple images')
     parser.add_argument('input_dir', help='Directory containing input images')
@@ -149,6 +413,9 @@ def main():
     parser.add_argument('--sprite-height', type=int, default=32, help='individual sprite height in pixels (default: 32)')
     parser.add_argument('--width', type=int, default=512, help='Atlas width in pixels (default: 512)')
     parser.add_argument('--height', type=int, default=512, help='Atlas height in pixels (default: 512)')
+    parser.add_argument('--format', choices=['png', 'webp'], default='png', help='Atlas image format (default: png)')
+    parser.add_argument('--compress-level', type=int, choices=range(10), default=1, metavar='0-9', help='PNG zlib compression level, higher is smaller but slower (default: 1)')
+    parser.add_argument('--workers', type=positive_int, default=None, help='Number of decode/resize threads (default: CPU count)')
     parser.add_argument('--mapping', help='Path to save mapping file (default: output_path with _mapping.txt suffix)')
     
     args = parser.parse_args()
@@ -161,14 +428,18 @@ def main():
             sprite_width=args.sprite_width,
             sprite_height=args.sprite_height,
             atlas_width=args.width,
-            atlas_height=args.height
+            atlas_height=args.height,
+            output_format=args.format,
+            compress_level=args.compress_level,
+            max_workers=args.workers
         )
         
         mapping = generator.create_atlas()
         generator.save_mapping_file(mapping, args.mapping)
+        atlas_file = generator.wait_for_atlas()
         
         print("\nAtlas generation complete!")
-        print(f"- Atlas: {args.output_path}")
+        print(f"- Atlas: {atlas_file}")
         print(f"- Processed {len(mapping)} images")
         
     except Exception as e: